@@ -1,16 +1,24 @@
 import streamlit as st
-import json
+import os
+import hashlib
+import tempfile
 import numpy as np
+import orjson
 from pathlib import Path
 import logging
+import torch
+import pyarrow as pa
+import pyarrow.parquet as pq
 from typing import List, Dict, Any
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDINGS_CACHE_DIR = Path(".embeddings_cache")
+
 # Page configuration
 st.set_page_config(
     page_title="Kerkliedjies aanbevelings",
@@ -74,8 +82,8 @@ st.markdown("""
 def load_songs_data(file_path: str = "combined_songs.json") -> List[Dict[str, Any]]:
     """Load songs data from JSON file with caching."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            songs = json.load(f)
+        with open(file_path, 'rb') as f:
+            songs = orjson.loads(f.read())
         logger.info(f"Loaded {len(songs)} songs from {file_path}")
         return songs
     except FileNotFoundError:
@@ -89,38 +97,129 @@ def load_songs_data(file_path: str = "combined_songs.json") -> List[Dict[str, An
 
 @st.cache_data
 def preprocess_songs(songs: List[Dict[str, Any]]) -> tuple:
-    """Preprocess songs for faster vectorization."""
-    song_texts = []
+    """Preprocess songs for faster vectorization.
+
+    Identical lyric texts are only kept once; song_text_idx maps each song
+    name to its row in the unique texts, and song_index maps each filename
+    to its position in songs.
+    """
+    text_to_idx = {}
+    unique_texts = []
+    song_text_idx = []
     song_names = []
+    song_index = {}
     
-    for song in songs:
+    for i, song in enumerate(songs):
         # Combine all lyrics into a single text
         lyrics_text = " ".join(song.get('lyrics', []))
         if lyrics_text.strip():
-            song_texts.append(lyrics_text)
+            idx = text_to_idx.setdefault(lyrics_text, len(unique_texts))
+            if idx == len(unique_texts):
+                unique_texts.append(lyrics_text)
+            song_text_idx.append(idx)
             song_names.append(song.get('filename', 'Unknown'))
+            song_index.setdefault(song.get('filename', 'Unknown'), i)
     
-    return song_texts, song_names
+    return unique_texts, song_names, np.asarray(song_text_idx, dtype=np.intp), song_index
+
+def get_embeddings_cache_path(song_texts: List[str], _model) -> Path:
+    """Build the on-disk embeddings cache path, keyed by model and song texts."""
+    quantized = getattr(_model, 'is_quantized', False)
+    key = hashlib.sha256(orjson.dumps([MODEL_NAME, quantized, song_texts])).hexdigest()[:16]
+    return EMBEDDINGS_CACHE_DIR / f"embeddings_{key}.parquet"
 
 @st.cache_resource
 def get_song_embeddings(song_texts: List[str], _model) -> tuple:
-    """Cache song embeddings for faster recommendations."""
+    """Cache song embeddings in memory and on disk for faster recommendations."""
     if not _model or not song_texts:
         return None, None
     
-    # Create embeddings
-    embeddings = _model.encode(song_texts, convert_to_tensor=True, show_progress_bar=False)
+    # Reuse embeddings persisted by a previous run
+    cache_path = get_embeddings_cache_path(song_texts, _model)
+    if cache_path.exists():
+        try:
+            table = pq.read_table(cache_path)
+            column = table.column('embedding').combine_chunks()
+            embeddings = column.flatten().to_numpy().reshape(-1, column.type.list_size)
+            if embeddings.shape[0] != len(song_texts):
+                raise ValueError(f"expected {len(song_texts)} rows, found {embeddings.shape[0]}")
+            logger.info(f"Loaded song embeddings from {cache_path}")
+            return embeddings, song_texts
+        except Exception as e:
+            logger.warning(f"Could not load cached embeddings from {cache_path}: {e}")
+    
+    # Create embeddings in larger batches without autograd bookkeeping
+    with torch.inference_mode():
+        embeddings = _model.encode(
+            song_texts,
+            batch_size=128,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+    # Keep a contiguous float32 matrix so scoring is a single matrix-vector product
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    
+    tmp_path = None
+    try:
+        EMBEDDINGS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        table = pa.table({
+            'embedding': pa.FixedSizeListArray.from_arrays(
+                pa.array(embeddings.reshape(-1), type=pa.float32()),
+                embeddings.shape[1]
+            )
+        })
+        # Write to a temporary file first so readers never see a partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=EMBEDDINGS_CACHE_DIR, suffix='.tmp')
+        os.close(fd)
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+        logger.info(f"Saved song embeddings to {cache_path}")
+        
+        # Drop caches left behind by earlier song data or model settings
+        for stale_path in EMBEDDINGS_CACHE_DIR.glob("embeddings_*"):
+            if stale_path != cache_path:
+                try:
+                    stale_path.unlink()
+                except OSError as e:
+                    logger.warning(f"Could not remove stale embeddings cache {stale_path}: {e}")
+    except Exception as e:
+        logger.warning(f"Could not save embeddings to {cache_path}: {e}")
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    
     return embeddings, song_texts
 
+@st.cache_data(show_spinner=False, max_entries=32)
+def encode_sermon(sermon_text: str, _model) -> np.ndarray:
+    """Cache the normalized sermon embedding so repeated requests skip the model."""
+    with torch.inference_mode():
+        embedding = _model.encode(sermon_text, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    return np.asarray(embedding, dtype=np.float32)
+
 @st.cache_resource
 def initialize_model():
     """Initialize the sentence transformer model with caching."""
     try:
         with st.spinner("Laai AI model..."):
             # Use a faster, lighter model for better performance
-            model = SentenceTransformer('all-MiniLM-L6-v2')
+            model = SentenceTransformer(MODEL_NAME)
             # Set model to evaluation mode for faster inference
             model.eval()
+            model.is_quantized = False
+            # Quantize the linear layers to int8; dynamic quantization is CPU-only
+            if model.device.type == 'cpu':
+                try:
+                    # Quantize a copy so a failure leaves the FP32 model untouched
+                    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                    model.is_quantized = True
+                except Exception as e:
+                    logger.warning(f"Could not quantize model, using FP32: {e}")
         logger.info("Sentence transformer model loaded successfully")
         return model
     except Exception as e:
@@ -134,26 +233,29 @@ def get_recommendations_fast(sermon_text: str, songs: List[Dict[str, Any]], _mod
         return []
     
     # Get preprocessed data
-    song_texts, song_names = preprocess_songs(songs)
+    song_texts, song_names, song_text_idx, song_index = preprocess_songs(songs)
     if not song_texts:
         return []
     
-    # Get cached embeddings
+    # Get cached embeddings (one row per unique lyric text)
     song_embeddings, _ = get_song_embeddings(song_texts, _model)
     if song_embeddings is None:
         return []
     
-    # Vectorize sermon text (this is fast since it's just one text)
-    sermon_embedding = _model.encode([sermon_text], convert_to_tensor=True, show_progress_bar=False)
+    # Vectorize sermon text (cached per sermon)
+    sermon_embedding = encode_sermon(sermon_text, _model)
     
-    # Calculate similarities
-    similarities = cosine_similarity(
-        sermon_embedding.cpu().numpy(), 
-        song_embeddings.cpu().numpy()
-    )[0]
+    # Embeddings are normalized, so the dot product is the cosine similarity;
+    # score each unique text once, then spread the scores back over all songs
+    similarities = (song_embeddings @ sermon_embedding)[song_text_idx]
     
-    # Get top recommendations
-    top_indices = np.argsort(similarities)[::-1][:top_k]
+    # Get top recommendations: partition for the top-k first, then sort only those k scores
+    k = min(top_k, similarities.size)
+    if k <= 0:
+        return []
+    neg_similarities = -similarities
+    top_indices = np.argpartition(neg_similarities, k - 1)[:k]
+    top_indices = top_indices[np.argsort(neg_similarities[top_indices])]
     
     recommendations = []
     for idx in top_indices:
@@ -161,8 +263,9 @@ def get_recommendations_fast(sermon_text: str, songs: List[Dict[str, Any]], _mod
         similarity_score = similarities[idx]
         
         # Find the original song data
-        song_data = next((s for s in songs if s.get('filename') == song_name), None)
-        if song_data:
+        idx_in_songs = song_index.get(song_name)
+        if idx_in_songs is not None:
+            song_data = songs[idx_in_songs]
             recommendations.append({
                 'filename': song_name,
                 'lyrics': song_data.get('lyrics', []),
@@ -171,11 +274,6 @@ def get_recommendations_fast(sermon_text: str, songs: List[Dict[str, Any]], _mod
     
     return recommendations
 
-# Legacy function - kept for compatibility but not used
-def get_recommendations(sermon_text: str, songs: List[Dict[str, Any]], _model, top_k: int = 5) -> List[Dict[str, Any]]:
-    """Legacy function - use get_recommendations_fast instead."""
-    return get_recommendations_fast(sermon_text, songs, _model, top_k)
-
 def main():
     """Main Streamlit app function."""
     
@@ -194,7 +292,7 @@ def main():
     # Preload embeddings in background
     if songs_data and model:
         with st.spinner("⚡ Berei AI model voor vir vinnige aanbevelings..."):
-            song_texts, _ = preprocess_songs(songs_data)
+            song_texts, _, _, _ = preprocess_songs(songs_data)
             get_song_embeddings(song_texts, model)
     
     # Display song count